@@ -15,19 +15,65 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
+import os
 import bpy
 import gc
+import bisect
+import importlib
 import concurrent.futures
 
+RELOAD_CORE = False
+"""Reload the MotionEngine core on script reload. Compiled extensions cannot be hot-reloaded, so only for debugging."""
+
+DEBUG_GC = False
+"""Force full garbage collections around (un)registration. These stall the UI on large files, so only for debugging."""
+
+if '_module_mtimes' not in locals():
+    _module_mtimes = {}
+
+
+def _get_mtime(module):
+    """
+    Get a snapshot of a module's source files that changes whenever the module would need reloading
+    :param module: Module to inspect
+    :return: The source file's mtime for plain modules. For packages, the sorted (path, mtime) pairs of every
+     .py file in the package directory, so added and removed files are detected as well. None if unavailable.
+    """
+    path = getattr(module, '__file__', None)
+    if path is None or not os.path.exists(path):
+        return None
+    if not hasattr(module, '__path__'):
+        return os.path.getmtime(path)
+    files = []
+    for root, _, filenames in os.walk(os.path.dirname(path)):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                file_path = os.path.join(root, filename)
+                files.append((file_path, os.path.getmtime(file_path)))
+    return tuple(sorted(files))
+
+
+def _reload_if_modified(module):
+    """
+    Reloads a module only if its source files changed since it was last loaded
+    :param module: Module to reload
+    :return: The reloaded module, or the same module if unchanged
+    """
+    mtime = _get_mtime(module)
+    if mtime is None or _module_mtimes.get(module.__name__) != mtime:
+        module = importlib.reload(module)
+    _module_mtimes[module.__name__] = mtime
+    return module
+
+
 if 'MotionEngine' in locals():
-    import importlib
-
-    importlib.reload(MotionEngine)
-    importlib.reload(global_vars)
-    importlib.reload(ui)
-    importlib.reload(operators)
-    importlib.reload(property_groups)
-    importlib.reload(ui_props)
+    if RELOAD_CORE:
+        MotionEngine = importlib.reload(MotionEngine)
+    global_vars = _reload_if_modified(global_vars)
+    ui = _reload_if_modified(ui)
+    operators = _reload_if_modified(operators)
+    property_groups = _reload_if_modified(property_groups)
+    ui_props = _reload_if_modified(ui_props)
 else:
     from . import MotionEngine
     from . import global_vars
@@ -36,6 +82,9 @@ else:
     from . import property_groups
     from .property_groups import ui_props
 
+    for _module in (global_vars, ui, operators, property_groups, ui_props):
+        _module_mtimes[_module.__name__] = _get_mtime(_module)
+
 bl_info = {
     "name": "MotionEngine",
     "author": "Ian Sloat",
@@ -50,6 +99,24 @@ bl_info = {
 
 registered = False
 
+# Core lib compatibility modes, keyed by the first Blender version they no longer apply to
+_COMPAT_TABLE = [
+    ((2, 93, 4), MotionEngine.VER_2_93_0),
+    ((3, 0, 0), MotionEngine.VER_2_93_4),
+    ((3, 1, 0), MotionEngine.VER_3_0_0),
+    ((3, 2, 0), MotionEngine.VER_3_1_0),
+    ((3, 3, 0), MotionEngine.VER_3_2_0),
+    ((3, 4, 0), MotionEngine.VER_3_3_0),
+    ((3, 5, 0), MotionEngine.VER_3_4_0),
+    ((3, 6, 0), MotionEngine.VER_3_5_0),
+    ((3, 6, 8), MotionEngine.VER_3_6_0),
+    ((4, 0, 0), MotionEngine.VER_3_6_8),
+    ((4, 1, 0), MotionEngine.VER_4_0_0),
+    ((4, 2, 0), MotionEngine.VER_4_1_0),
+]
+_COMPAT_VERSIONS = [v for (v, _) in _COMPAT_TABLE]
+_COMPAT_LATEST = MotionEngine.VER_4_2_0
+
 
 def register():
     global registered
@@ -61,34 +128,8 @@ def register():
         registered = False
         return
 
-    compat_ver = None
-
-    if bpy.app.version < (2, 93, 4):
-        compat_ver = MotionEngine.VER_2_93_0
-    elif bpy.app.version < (3, 0, 0):
-        compat_ver = MotionEngine.VER_2_93_4
-    elif bpy.app.version < (3, 1, 0):
-        compat_ver = MotionEngine.VER_3_0_0
-    elif bpy.app.version < (3, 2, 0):
-        compat_ver = MotionEngine.VER_3_1_0
-    elif bpy.app.version < (3, 3, 0):
-        compat_ver = MotionEngine.VER_3_2_0
-    elif bpy.app.version < (3, 4, 0):
-        compat_ver = MotionEngine.VER_3_3_0
-    elif bpy.app.version < (3, 5, 0):
-        compat_ver = MotionEngine.VER_3_4_0
-    elif bpy.app.version < (3, 6, 0):
-        compat_ver = MotionEngine.VER_3_5_0
-    elif bpy.app.version < (3, 6, 8):
-        compat_ver = MotionEngine.VER_3_6_0
-    elif bpy.app.version < (4, 0, 0):
-        compat_ver = MotionEngine.VER_3_6_8
-    elif bpy.app.version < (4, 1, 0):
-        compat_ver = MotionEngine.VER_4_0_0
-    elif bpy.app.version < (4, 2, 0):
-        compat_ver = MotionEngine.VER_4_1_0
-    else:
-        compat_ver = MotionEngine.VER_4_2_0
+    idx = bisect.bisect_right(_COMPAT_VERSIONS, tuple(bpy.app.version))
+    compat_ver = _COMPAT_TABLE[idx][1] if idx < len(_COMPAT_TABLE) else _COMPAT_LATEST
 
     MotionEngine.set_compatibility_mode(compat_ver)
 
@@ -96,25 +137,23 @@ def register():
 
     # Component registration
 
-    gc.collect()
-
-    for CLASS in property_groups.ALL_CLASSES:
-        bpy.utils.register_class(CLASS)
-
-    for CLASS in operators.ALL_CLASSES:
-        bpy.utils.register_class(CLASS)
+    if DEBUG_GC:
+        gc.collect()
 
-    for CLASS in ui.ALL_CLASSES:
-        bpy.utils.register_class(CLASS)
+    property_groups.register()
+    operators.register()
+    ui.register()
 
     bpy.types.Scene.motion_engine_ui_properties = bpy.props.PointerProperty(type=ui_props.UIProperties)
 
     global_vars.ui_lock_state = False
     global_vars.shutdown_state = False
 
-    global_vars.executor = concurrent.futures.ThreadPoolExecutor()
+    global_vars.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                                 thread_name_prefix='MotionEngine')
 
-    gc.collect()
+    if DEBUG_GC:
+        gc.collect()
 
     print("[MotionEngine] Registration complete.")
 
@@ -123,14 +162,9 @@ def register():
 
 def unregister():
     if registered:
-        for CLASS in ui.ALL_CLASSES:
-            bpy.utils.unregister_class(CLASS)
-
-        for CLASS in operators.ALL_CLASSES:
-            bpy.utils.unregister_class(CLASS)
-
-        for CLASS in property_groups.ALL_CLASSES:
-            bpy.utils.unregister_class(CLASS)
+        ui.unregister()
+        operators.unregister()
+        property_groups.unregister()
 
         global_vars.ui_lock_state = False
 
@@ -140,7 +174,8 @@ def unregister():
 
         global_vars.executor.shutdown()
 
-        gc.collect()
+        if DEBUG_GC:
+            gc.collect()
 
     print("[MotionEngine] Unregistration complete.")
 
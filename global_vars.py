@@ -88,5 +88,9 @@ def unlink_from_all_collections(obj):
 
 
 executor = None
+"""
+Thread pool for background tracking tasks. Tasks share loaded models and event queues with their operators,
+so they must stay in-process. MotionEngine releases the GIL during model inference and frame decoding.
+"""
 
 shutdown_state = False
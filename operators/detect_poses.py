@@ -403,7 +403,9 @@ class DetectPosesOperator(bpy.types.Operator):
                             orig_marker = track.markers[frame]
                             area = utils.get_marker_area(orig_marker, clip_size, True)
                             original_conf = area / 100
-                        if conf > min(original_conf, 100):
+                            if original_conf > 100:
+                                original_conf = 100
+                        if conf > original_conf:
                             x = pose[j].pt.x / clip_size[0]
                             y = (clip_size[1] - pose[j].pt.y) / clip_size[1]
                             box_area = conf * 100
@@ -16,6 +16,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 import os
 import importlib
+import bpy
 
 current_dir = os.path.dirname(__file__) if __file__ else '.'
 
@@ -31,3 +32,4 @@ for mod in modules:
     except ImportError as e:
         print(f"Error importing module {mod}: {e}")
 
+register, unregister = bpy.utils.register_classes_factory(ALL_CLASSES)
@@ -15,7 +15,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 import os
+from collections import defaultdict
 import bpy
+import numpy as np
 from . import MotionEngine as me
 
 
@@ -63,17 +65,17 @@ def prepare_camera_for_clip(movie_clip: bpy.types.MovieClip, context: bpy.types.
 
 
 _pose_sources = None
+_pose_sources_set = None
+
+_tag_sources_set = frozenset(me.TagDictionary.__members__) | {'ML'}
 
 
 def update_pose_sources():
-    global _pose_sources
+    global _pose_sources, _pose_sources_set
     models = me.get_models('pose_estimation', ['target_class', 'keypoints'])
-    classes = list({m_attr['target_class'] for (m_name, m_attr) in models})
-    kp_nums = list({m_attr['keypoints'] for (m_name, m_attr) in models})
-    _pose_sources = []
-    for cl in classes:
-        for kpn in kp_nums:
-            _pose_sources.append(f'{cl}{kpn}')
+    pairs = {(m_attr['target_class'], m_attr['keypoints']) for (m_name, m_attr) in models}
+    _pose_sources = [f'{cl}{kpn}' for (cl, kpn) in pairs]
+    _pose_sources_set = frozenset(_pose_sources)
 
 
 def get_pose_sources():
@@ -82,6 +84,12 @@ def get_pose_sources():
     return _pose_sources
 
 
+def _get_pose_sources_set():
+    if _pose_sources_set is None:
+        update_pose_sources()
+    return _pose_sources_set
+
+
 def is_valid_joint_name(name: str):
     """
     Checks if the provided input string meets the naming standards for tracks generated by the pose detector
@@ -103,16 +111,71 @@ def is_valid_joint_name(name: str):
     :param name: The name to test
     :return: True if the name meets these requirements
     """
-    pose_sources = get_pose_sources()
+    return classify_track_name(name) == TRACK_JOINT
+
+
+TRACK_OTHER = 0
+TRACK_JOINT = 1
+TRACK_TAG = 2
+
+
+def _is_int(value: str):
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def classify_track_name(name: str, pose_sources_set=None, tag_sources_set=None):
+    """
+    Classifies a track name as a pose joint, a tag, or any other track in a single pass.
+    This is the single definition of the naming standards checked by is_valid_joint_name and is_valid_tag_name.
+    :param name: The name to classify
+    :param pose_sources_set: Set of valid pose sources. Fetched from the model registry if None.
+    :param tag_sources_set: Set of valid tag sources. Uses the MotionEngine tag dictionaries if None.
+    :return: TRACK_JOINT, TRACK_TAG, or TRACK_OTHER
+    """
+    if pose_sources_set is None:
+        pose_sources_set = _get_pose_sources_set()
+    if tag_sources_set is None:
+        tag_sources_set = _tag_sources_set
     split_name = name.split('.')
-    format_check = len(split_name) >= 3 and split_name[-2] in pose_sources
-    value_check = format_check
-    if value_check:
-        try:
-            int(split_name[-1])
-        except ValueError:
-            value_check = False
-    return format_check and value_check
+    if len(split_name) < 3:
+        return TRACK_OTHER
+    if split_name[-2] in pose_sources_set and _is_int(split_name[-1]):
+        return TRACK_JOINT
+    if split_name[0] == 'Tag' and split_name[1] in tag_sources_set and _is_int(split_name[2]):
+        return TRACK_TAG
+    return TRACK_OTHER
+
+
+def get_collection_array(collection: bpy.types.bpy_prop_collection, attr: str, shape=(), dtype=np.float32):
+    """
+    Read a numeric or boolean attribute from every item in a collection in one bulk copy.
+    String attributes such as names are not supported by foreach_get.
+    :param collection: Collection to read from, e.g. a clip's tracks or a track's markers
+    :param attr: Name of the item attribute to read
+    :param shape: Shape of the attribute on a single item, e.g. (2,) for co or (4, 2) for pattern_corners
+    :param dtype: Array data type. Must match the attribute's underlying type.
+    :return: Array of shape (len(collection), *shape)
+    """
+    n = len(collection)
+    values = np.empty(n * int(np.prod(shape)), dtype=dtype)
+    collection.foreach_get(attr, values)
+    return values.reshape((n, *shape))
+
+
+def filter_tracks(tracks: bpy.types.MovieTrackingTracks, attr: str):
+    """
+    Get all tracks that have a boolean attribute set, reading the attribute for all tracks in one bulk copy
+    :param tracks: Track collection to filter
+    :param attr: Name of the boolean track attribute, e.g. 'lock' or 'select'
+    :return: List of tracks with attr set to True
+    """
+    # Tracks are stored in a linked list, so iterate alongside the flags instead of indexing into the collection
+    flags = get_collection_array(tracks, attr, dtype=bool).tolist()
+    return [track for (track, flag) in zip(tracks, flags) if flag]
 
 
 def get_joint_tracks(movie_clip: bpy.types.MovieClip, filter_locked=False):
@@ -136,132 +199,178 @@ def get_joint_tracks(movie_clip: bpy.types.MovieClip, filter_locked=False):
     """
     track_dict = {}
     tracks = []
+    pose_sources_set = _get_pose_sources_set()
+    clip_tracks = movie_clip.tracking.tracks
+    if filter_locked:
+        clip_tracks = filter_tracks(clip_tracks, 'lock')
 
-    for track in movie_clip.tracking.tracks:
-        if not is_valid_joint_name(track.name):
-            continue
-        if filter_locked and not track.lock:
+    for track in clip_tracks:
+        if classify_track_name(track.name, pose_sources_set, _tag_sources_set) != TRACK_JOINT:
             continue
-        split_name = track.name.split('.')
-        joint_id = int(split_name[-1])
-        pose_name = ''
-        for i in range(len(split_name) - 2):
-            if pose_name != '':
-                pose_name += '.' + split_name[i]
-            else:
-                pose_name = split_name[i]
+        pose_name, source, joint_id = track.name.rsplit('.', 2)
+        joint_id = int(joint_id)
         if pose_name not in track_dict:
             track_dict[pose_name] = {}
-        if split_name[-2] not in track_dict[pose_name]:
-            track_dict[pose_name][split_name[-2]] = {}
-        track_dict[pose_name][split_name[-2]][joint_id] = track
+        if source not in track_dict[pose_name]:
+            track_dict[pose_name][source] = {}
+        track_dict[pose_name][source][joint_id] = track
         tracks.append(track)
 
     return track_dict, tracks
 
 
+def get_marker_corners(marker: bpy.types.MovieTrackingMarker, parent_clip_size: tuple[int, int]):
+    """
+    Get the corners of a marker's pattern area in pixel coordinates
+    :param marker: Marker to measure
+    :param parent_clip_size: Size of the clip the marker belongs to
+    :return: List of 4 (x, y) corners
+    """
+    cw, ch = parent_clip_size
+    co_x, co_y = marker.co
+    return [(cw * (co_x + x), ch * (co_y + y)) for (x, y) in marker.pattern_corners]
+
+
 def get_marker_dims(marker: bpy.types.MovieTrackingMarker, parent_clip_size: tuple[int, int]):
-    co = marker.co
-    corners = marker.pattern_corners
-    corners = [(parent_clip_size[0] * (co[0] + x), parent_clip_size[1] * (co[1] + y)) for (x, y) in corners]
-    min_x = min([x for (x, y) in corners])
-    max_x = max([x for (x, y) in corners])
-    min_y = min([y for (x, y) in corners])
-    max_y = max([y for (x, y) in corners])
+    """
+    Get the bounding box of a marker's pattern area in pixel coordinates
+    :param marker: Marker to measure
+    :param parent_clip_size: Size of the clip the marker belongs to
+    :return: (min_x, min_y), (max_x, max_y), width, height
+    """
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = get_marker_corners(marker, parent_clip_size)
+    # Pairwise comparisons are cheaper than min()/max() over a temporary list for 4 elements
+    min_x, max_x = (x0, x1) if x0 < x1 else (x1, x0)
+    lo, hi = (x2, x3) if x2 < x3 else (x3, x2)
+    min_x = min_x if min_x < lo else lo
+    max_x = max_x if max_x > hi else hi
+    min_y, max_y = (y0, y1) if y0 < y1 else (y1, y0)
+    lo, hi = (y2, y3) if y2 < y3 else (y3, y2)
+    min_y = min_y if min_y < lo else lo
+    max_y = max_y if max_y > hi else hi
     width = abs(max_x - min_x)
     height = abs(max_y - min_y)
     return (min_x, min_y), (max_x, max_y), width, height
 
 
+def get_polygon_area(corners):
+    """
+    Computes the area of a simple polygon using the shoelace formula
+    :param corners: Polygon vertices in order. Can be any array-like of shape (N, 2), or (..., N, 2) for a batch.
+    :return: Unsigned polygon area, or an array of areas for a batch of polygons
+    """
+    c = np.asarray(corners, dtype=np.float64)
+    x = c[..., 0]
+    y = c[..., 1]
+    return 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=-1) - y * np.roll(x, -1, axis=-1), axis=-1))
+
+
 def get_marker_area(marker: bpy.types.MovieTrackingMarker, parent_clip_size: tuple[int, int], get_exact=False):
-    (_, min_y), _, width, height = get_marker_dims(marker, parent_clip_size)
     if get_exact:
-        co = marker.co
-        corners = marker.pattern_corners
-        corners = [(parent_clip_size[0] * (co[0] + x), parent_clip_size[1] * (co[1] + y)) for (x, y) in corners]
-        areas = []
-        for i in range(len(corners)):
-            c_a = corners[i % len(corners)]
-            c_b = corners[(i + 1) % len(corners)]
-            width = c_b[0] - c_a[0]
-            height = ((c_a[1] - min_y) + (c_b[1] - min_y)) / 2
-            areas.append(width * height)
-        return abs(sum(areas))
+        # Closed-form shoelace on the 4 corners. Cheaper than get_polygon_area for a single marker.
+        (x0, y0), (x1, y1), (x2, y2), (x3, y3) = get_marker_corners(marker, parent_clip_size)
+        return abs((x0 * y1 - x1 * y0) + (x1 * y2 - x2 * y1) + (x2 * y3 - x3 * y2) + (x3 * y0 - x0 * y3)) / 2
+    _, _, width, height = get_marker_dims(marker, parent_clip_size)
     return width * height
 
 
-def get_clip_poses(movie_clip: bpy.types.MovieClip, joint_conf_thresh=0.9, filter_locked=False):
+def get_clip_poses(movie_clip: bpy.types.MovieClip, joint_conf_thresh=0.9, filter_locked=False, clip_info=None,
+                   clip_size=None):
     """
     Get all named poses on the provided clip, converting them to a format compatible with
     MotionEngine.tracking.TrackData
     :param movie_clip: Clip to extract data from
     :param joint_conf_thresh: Joint confidence threshold
     :param filter_locked: If true, only use locked tracks for tracking data
+    :param clip_info: ClipInfo for movie_clip. Created from movie_clip if None.
+    :param clip_size: Size of movie_clip. Read from movie_clip if None.
     :return: Nested dictionary with mappings to frames and named poses. Frames will be in scene time.
     """
-    output = {}
+    output = defaultdict(dict)
     track_dict, tracks = get_joint_tracks(movie_clip, filter_locked)
-    clip_info = ClipInfo(movie_clip)
-    clip_size = movie_clip.size
+    if clip_info is None:
+        clip_info = ClipInfo(movie_clip)
+    if clip_size is None:
+        clip_size = movie_clip.size
+    clip_size = np.array(clip_size, dtype=np.float64)
     for pose_name, sources in track_dict.items():
         for source, joints in sources.items():
             actual_pose_name = f'{pose_name}.{source}'
+            frame_poses = {}
             for joint, joint_track in joints.items():
-                for marker in joint_track.markers:
-                    scene_frame = clip_info.clip_to_scene(marker.frame)
-                    conf = min(100.0, max(0.0, get_marker_area(marker, clip_size, True))) / 100.0
-                    if conf < joint_conf_thresh:
-                        continue
-                    x = marker.co[0] * clip_size[0]
-                    y = clip_size[1] - marker.co[1] * clip_size[1]
-                    if scene_frame not in output:
-                        output[scene_frame] = {}
-                    if actual_pose_name not in output[scene_frame]:
-                        output[scene_frame][actual_pose_name] = me.dnn.Pose()
-                    output[scene_frame][actual_pose_name].set_joint(joint, x, y, conf)
-
-    return output
-
-
-def get_clip_detections(movie_clip: bpy.types.MovieClip, filter_locked=False):
+                markers = joint_track.markers
+                if len(markers) == 0:
+                    continue
+                frames = get_collection_array(markers, 'frame', dtype=np.int32)
+                # Read as float32 for a fast bulk copy, but do the math in double like the scalar path
+                co = get_collection_array(markers, 'co', (2,)).astype(np.float64)
+                pattern_corners = get_collection_array(markers, 'pattern_corners', (4, 2)).astype(np.float64)
+                corners = (co[:, None, :] + pattern_corners) * clip_size
+                conf = np.clip(get_polygon_area(corners), 0.0, 100.0) / 100.0
+                keep = conf >= joint_conf_thresh
+                xs = co[keep, 0] * clip_size[0]
+                ys = clip_size[1] - co[keep, 1] * clip_size[1]
+                for frame, x, y, c in zip(frames[keep].tolist(), xs.tolist(), ys.tolist(), conf[keep].tolist()):
+                    scene_frame = clip_info.clip_to_scene(frame)
+                    pose = frame_poses.get(scene_frame)
+                    if pose is None:
+                        pose = frame_poses[scene_frame] = me.dnn.Pose()
+                    pose.set_joint(joint, x, y, c)
+            for scene_frame, pose in frame_poses.items():
+                output[scene_frame][actual_pose_name] = pose
+
+    return dict(output)
+
+
+def get_clip_detections(movie_clip: bpy.types.MovieClip, filter_locked=False, clip_info=None, clip_size=None):
     """
     Get all named object detections on the provided clip, converting them to a format compatible with
     MotionEngine.tracking.TrackData
     :param movie_clip: Clip to extract data from
     :param filter_locked: If true, only use locked tracks for tracking data
+    :param clip_info: ClipInfo for movie_clip. Created from movie_clip if None.
+    :param clip_size: Size of movie_clip. Read from movie_clip if None.
     :return: Nested dictionary with mappings to frames and named detections
     """
     output = {}
-    clip_info = ClipInfo(movie_clip)
-    clip_size = movie_clip.size
-    for track in movie_clip.tracking.tracks:
-        if filter_locked and not track.lock:
-            continue
-        if is_valid_joint_name(track.name) or is_valid_tag_name(track.name):
+    if clip_info is None:
+        clip_info = ClipInfo(movie_clip)
+    if clip_size is None:
+        clip_size = movie_clip.size
+    clip_size = tuple(clip_size)
+    clip_height = clip_size[1]
+    pose_sources_set = _get_pose_sources_set()
+    clip_tracks = movie_clip.tracking.tracks
+    if filter_locked:
+        clip_tracks = filter_tracks(clip_tracks, 'lock')
+    for track in clip_tracks:
+        track_name = track.name
+        if classify_track_name(track_name, pose_sources_set, _tag_sources_set) != TRACK_OTHER:
             continue
         for marker in track.markers:
             scene_frame = clip_info.clip_to_scene(marker.frame)
             bl, tr, width, height = get_marker_dims(marker, clip_size)
             tl_x = bl[0]
-            tl_y = clip_size[1] - tr[1]
+            tl_y = clip_height - tr[1]
             if scene_frame not in output:
                 output[scene_frame] = {}
-            output[scene_frame][track.name] = me.dnn.Detection(0, me.Rect(tl_x, tl_y, width, height), 1)
+            output[scene_frame][track_name] = me.dnn.Detection(0, me.Rect(tl_x, tl_y, width, height), 1)
     return output
 
 
 def is_valid_tag_name(name: str):
-    split_name = name.split('.')
-    if len(split_name) < 3:
-        return False
-    valid_sources = [e for e in me.TagDictionary.__members__]
-    valid_sources.append('ML')
-    valid_id = True
-    try:
-        int(split_name[2])
-    except ValueError:
-        valid_id = False
-    return valid_id and split_name[0] == 'Tag' and split_name[1] in valid_sources
+    """
+    Checks if the provided input string meets the naming standards for tracks generated by the tag detector
+
+    Tag.tag_source.ID
+
+    Where tag_source is a MotionEngine.TagDictionary member or 'ML', and ID is an integer.
+    Any further '.' separated elements after the ID are ignored.
+
+    :param name: The name to test
+    :return: True if the name meets these requirements
+    """
+    return classify_track_name(name) == TRACK_TAG
 
 
 def marker_to_tag(marker: bpy.types.MovieTrackingMarker, clip_size=(1, 1), fix_corner_order=True):
@@ -279,13 +388,16 @@ def marker_to_tag(marker: bpy.types.MovieTrackingMarker, clip_size=(1, 1), fix_c
     return new_tag
 
 
-def get_clip_tags(movie_clip: bpy.types.MovieClip, filter_locked=False):
+def get_clip_tags(movie_clip: bpy.types.MovieClip, filter_locked=False, clip_info=None, clip_size=None):
     """
     Get all tag detections on the provided clip
     :param movie_clip: Clip to extract data from
     :param filter_locked: If true, only use locked tracks for tracking data
+    :param clip_info: ClipInfo for movie_clip. Created from movie_clip if None.
+    :param clip_size: Size of movie_clip. Read from movie_clip if None.
     :return: Nested dictionary with mappings to frames and tags
     """
+    # TODO: Tag extraction is not implemented yet
     return {}
 
 
@@ -302,12 +414,16 @@ def get_clip_tracking_data(movie_clip: bpy.types.MovieClip, pose_joint_conf=0.9,
     :return: MEPython TrackingData object
     """
     result = me.tracking.TrackingData()
+    clip_info = ClipInfo(movie_clip)
+    clip_size = movie_clip.size
     if include_poses:
-        result.poses = get_clip_poses(movie_clip, pose_joint_conf, filter_locked)
+        result.poses = get_clip_poses(movie_clip, pose_joint_conf, filter_locked, clip_info, clip_size)
     if include_detections:
-        result.detections = get_clip_detections(movie_clip, filter_locked)
+        result.detections = get_clip_detections(movie_clip, filter_locked, clip_info, clip_size)
     if include_tags:
-        result.tags = get_clip_tags(movie_clip, filter_locked)
+        tags = get_clip_tags(movie_clip, filter_locked, clip_info, clip_size)
+        if tags:
+            result.tags = tags
     return result
 
 
@@ -353,64 +469,68 @@ class ClipInfo:
         self.clip_size = clip.size
         self.scene_first_frame = scene.frame_start
         self.scene_last_frame = scene.frame_end
+        self._scene_start = self.frame_start - self.frame_offset
+        self._clip_start = 1 - self.frame_offset
+        self._clip_to_scene_delta = self._scene_start - self._clip_start
 
     def get_scene_start(self):
         """
         Returns the scene frame number that the real initial frame will play at
         """
-        return self.frame_start - self.frame_offset
+        return self._scene_start
 
     def get_clip_start(self):
         """
         Returns the clip frame number that the real initial frame will play at
         """
-        return 1 - self.frame_offset
+        return self._clip_start
 
     def scene_to_true(self, scene_frame: int):
         """
         Converts the provided scene frame number to its equivalent true source frame number.
         Source frames are zero-indexed.
         """
-        return scene_frame - self.get_scene_start()
+        return scene_frame - self._scene_start
 
     def clip_to_true(self, clip_frame: int):
         """
         Converts the provided clip frame number to its equivalent true source frame number.
         Source frames are zero-indexed.
         """
-        return clip_frame - self.get_clip_start()
+        return clip_frame - self._clip_start
 
     def true_to_scene(self, true_frame: int):
         """
         Converts the provided true source frame number to its equivalent scene frame number.
         Source frames are zero-indexed.
         """
-        return true_frame + self.get_scene_start()
+        return true_frame + self._scene_start
 
     def true_to_clip(self, true_frame: int):
         """
         Converts the provided true source frame number to its equivalent clip frame number.
         Source frames are zero-indexed.
         """
-        return true_frame + self.get_clip_start()
+        return true_frame + self._clip_start
 
     def clip_to_scene(self, clip_frame: int):
         """
         Converts the provided clip frame number to its equivalent scene frame number.
         """
-        return self.true_to_scene(self.clip_to_true(clip_frame))
+        return clip_frame + self._clip_to_scene_delta
 
     def scene_to_clip(self, scene_frame: int):
         """
         Converts the provided scene frame number to its equivalent clip frame number.
         """
-        return self.true_to_clip(self.scene_to_true(scene_frame))
+        return scene_frame - self._clip_to_scene_delta
 
 
 def get_active_track_count(clip: bpy.types.MovieClip):
     count = 0
-    for track in clip.tracking.tracks:
-        if is_valid_joint_name(track.name) or is_valid_tag_name(track.name) or not track.select:
+    pose_sources_set = _get_pose_sources_set()
+    for track in filter_tracks(clip.tracking.tracks, 'select'):
+        if classify_track_name(track.name, pose_sources_set, _tag_sources_set) != TRACK_OTHER:
             continue
         count += 1
     return count
@@ -424,29 +544,37 @@ class ClipTrackingData(ClipInfo):
         self.all_tracks = set()
         self.track_data = {}
 
-        for track in clip.tracking.tracks:
-            if is_valid_joint_name(track.name) or is_valid_tag_name(track.name):
+        pose_sources_set = _get_pose_sources_set()
+        clip_tracks = clip.tracking.tracks
+        clip_size = np.array(self.clip_size, dtype=np.float64)
+        clip_height = clip_size[1]
+        track_data = self.track_data
+        selected = get_collection_array(clip_tracks, 'select', dtype=bool).tolist()
+        for track, is_selected in zip(clip_tracks, selected):
+            track_name = track.name
+            if classify_track_name(track_name, pose_sources_set, _tag_sources_set) != TRACK_OTHER:
+                continue
+            self.all_tracks.add(track_name)
+            if is_selected:
+                self.selected_tracks.add(track_name)
+            markers = track.markers
+            if len(markers) == 0:
                 continue
-            self.all_tracks.add(track.name)
-            if track.select:
-                self.selected_tracks.add(track.name)
-            for marker in track.markers:
-                frame = marker.frame
-                bbox = marker.pattern_bound_box
-                center = marker.co
-                x_bl = (center[0] + bbox[0][0]) * self.clip_size[0]
-                y_bl = (center[1] + bbox[0][1]) * self.clip_size[1]
-                x_tr = (center[0] + bbox[1][0]) * self.clip_size[0]
-                y_tr = (center[1] + bbox[1][1]) * self.clip_size[1]
-                true_center = ((x_bl + x_tr) / 2, (y_bl + y_tr) / 2)
-                width = abs(x_bl - x_tr)
-                height = abs(y_bl - y_tr)
-                x_tl = true_center[0] - width / 2
-                y_tl = true_center[1] + height / 2
-                me_rect = me.Rect(x_tl, self.clip_size[1] - y_tl, width, height)
-                if frame not in self.track_data:
-                    self.track_data[frame] = {}
-                self.track_data[frame][track.name] = me.dnn.Detection(0, me_rect, 1)
+            frames = get_collection_array(markers, 'frame', dtype=np.int32)
+            # Read as float32 for a fast bulk copy, but do the math in double like the scalar path
+            co = get_collection_array(markers, 'co', (2,)).astype(np.float64)
+            bbox = get_collection_array(markers, 'pattern_bound_box', (2, 2)).astype(np.float64)
+            bl = (co + bbox[:, 0, :]) * clip_size
+            tr = (co + bbox[:, 1, :]) * clip_size
+            true_center = (bl + tr) / 2
+            dims = np.abs(bl - tr)
+            x_tl = true_center[:, 0] - dims[:, 0] / 2
+            y_tl = clip_height - (true_center[:, 1] + dims[:, 1] / 2)
+            for frame, x, y, width, height in zip(frames.tolist(), x_tl.tolist(), y_tl.tolist(),
+                                                  dims[:, 0].tolist(), dims[:, 1].tolist()):
+                if frame not in track_data:
+                    track_data[frame] = {}
+                track_data[frame][track_name] = me.dnn.Detection(0, me.Rect(x, y, width, height), 1)
 
 
 def force_ui_draw():